@@ -5,15 +5,77 @@
 import logging
 import os
 import configparser
-import re
+import hashlib
+import threading
 import xml.etree.ElementTree as ET
-from requests.structures import CaseInsensitiveDict
-from requests import get
-from flask import Flask, Response, render_template, request, g, send_file, redirect
+import requests
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, render_template, request, g, redirect
 from io import BytesIO
+from urllib.parse import urlencode
 from PIL import Image, ImageDraw, ImageFont
 from osgeo import gdal, ogr, osr
 
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+gdal.UseExceptions()
+
+# supported OGC services
+SERVICES = frozenset(("wms",))
+# tags of the feature members in a GFI GML response
+GML_MEMBER_TAGS = frozenset(
+    (
+        "{http://www.opengis.net/wfs/2.0}member",
+        "{http://www.opengis.net/wfs}member",
+        "{http://www.opengis.net/gml}featureMember",
+        "{http://www.opengis.net/gml/3.2}featureMember",
+        "member",
+        "featureMember",
+    )
+)
+# same lookup done by libxml2 when lxml is available
+if etree is not None:
+    GML_MEMBER_XP = etree.XPath(
+        "boolean(/*/wfs2:member | /*/wfs:member | /*/gml:featureMember"
+        " | /*/gml32:featureMember | /*/member | /*/featureMember)",
+        namespaces={
+            "wfs2": "http://www.opengis.net/wfs/2.0",
+            "wfs": "http://www.opengis.net/wfs",
+            "gml": "http://www.opengis.net/gml",
+            "gml32": "http://www.opengis.net/gml/3.2",
+        },
+    )
+    GML_PARSER = etree.XMLParser(huge_tree=False, recover=False, resolve_entities=False)
+
+
+# coordinate transformations cache, gdal doesnt allow a transformation to be
+# used by several threads at the same time so each thread has its own
+TRANSFORMS = threading.local()
+
+
+# return a (cached) coordinate transformation between two epsg codes,
+# building it is costly (lookup in proj.db)
+def get_transform(s_epsg, t_epsg=2154):
+    cache = getattr(TRANSFORMS, "cache", None)
+    if cache is None:
+        cache = TRANSFORMS.cache = dict()
+    t = cache.get((s_epsg, t_epsg))
+    if t is None:
+        s_srs = osr.SpatialReference()
+        s_srs.ImportFromEPSG(s_epsg)
+        t_srs = osr.SpatialReference()
+        t_srs.ImportFromEPSG(t_epsg)
+        t = cache[(s_epsg, t_epsg)] = osr.CoordinateTransformation(s_srs, t_srs)
+    return t
+
+
 # read config file
 def init_app(app):
     config = configparser.ConfigParser()
@@ -29,12 +91,60 @@ def init_app(app):
         app.config.champ_insee = config["gdal"].get("insee")
     if "dgfip" in config.sections():
         app.config.apikey = config["dgfip"].get("apikey")
+    # number of decimals kept from the bbox for the insee codes cache
+    app.config.insee_cache_precision = 6
+    # Cache-Control max-age (in seconds) of the returned images
+    app.config.cache_max_age = 300
+    # size (in bytes) and lifetime (in seconds) of the merged tiles cache
+    tiles_size = 64 * 1024 * 1024
+    tiles_ttl = 300
+    if "cache" in config.sections():
+        app.config.insee_cache_precision = config["cache"].getint("insee_precision", 6)
+        app.config.cache_max_age = config["cache"].getint("max_age", 300)
+        tiles_size = config["cache"].getint("tiles_size", tiles_size)
+        tiles_ttl = config["cache"].getint("tiles_ttl", tiles_ttl)
+    cached_insee_for_bbox.cache_clear()
+    app.config.insee_missing_logged = False
+    # merged tiles cache, bounded by the size of the images
+    app.config.tiles_cache = TTLCache(
+        maxsize=tiles_size, ttl=tiles_ttl, getsizeof=lambda v: len(v[0])
+    )
+    # shared http session, reuses connections to inspire.cadastre.gouv.fr
+    app.config.http = requests.Session()
+    app.config.http.headers.update(
+        {
+            "User-Agent": "proxycad",
+            "Accept-Encoding": "gzip",
+            "Connection": "keep-alive",
+        }
+    )
+    app.config.http.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=64,
+            # retry connection errors and 502/504, not read timeouts: a
+            # stalled comm would hold the whole tile for several timeouts
+            max_retries=Retry(
+                total=2,
+                connect=2,
+                read=0,
+                backoff_factor=0.1,
+                status_forcelist=(502, 504),
+                raise_on_status=False,
+            ),
+        ),
+    )
+    # prebuild transformations for the most common crs (for this thread, the
+    # one serving requests with gunicorn sync workers)
+    for epsg in (4326, 3857):
+        get_transform(epsg)
+    get_transform(2154, 4326)
 
 
 # open gdal data source, return layer
 def get_layer():
     if "layer" not in g:
-        gdal.UseExceptions()
         if app.config.datasource.startswith("PG:"):
             g.ds = gdal.OpenEx(app.config.datasource, allowed_drivers=["PostgreSQL"])
         else:
@@ -48,39 +158,179 @@ def get_layer():
                 )
             )
             quit()
+        # only fetch the insee field, the geometry is still needed by the
+        # spatial filter on drivers that evaluate it client-side
+        defn = g.layer.GetLayerDefn()
+        # same case-insensitive lookup as GetField()
+        idx = defn.GetFieldIndex(app.config.champ_insee)
+        if idx >= 0:
+            g.layer.SetIgnoredFields(
+                ["OGR_STYLE"]
+                + [
+                    defn.GetFieldDefn(i).GetName()
+                    for i in range(defn.GetFieldCount())
+                    if i != idx
+                ]
+            )
+        elif not app.config.insee_missing_logged:
+            app.logger.error(
+                "{} not found in {}".format(
+                    app.config.champ_insee, app.config.couche_commune
+                )
+            )
+            app.config.insee_missing_logged = True
         # compute layer bbox so that we know the service extent for getcapabilities
         l93ext = g.layer.GetExtent()
         app.config.l93bbox = l93ext
         # reproject to WGS84
-        s_srs = osr.SpatialReference()
-        s_srs.ImportFromEPSG(2154)
-        t_srs = osr.SpatialReference()
-        t_srs.ImportFromEPSG(4326)
-        t = osr.CoordinateTransformation(s_srs, t_srs)
+        t = get_transform(2154, 4326)
         bl = t.TransformPoint(l93ext[0], l93ext[2])
         ur = t.TransformPoint(l93ext[1], l93ext[3])
         app.config.llbbox = (bl[0], bl[1], ur[0], ur[1])
     return g.layer
 
 
-app = Flask(__name__, template_folder=".")
-init_app(app)
+# max number of concurrent upstream queries per request
+MAX_WORKERS = 8
+# connect/read timeouts (in seconds) for upstream queries
+UPSTREAM_TIMEOUT = (3, 10)
+# number of bytes of a GFI html response searched for a feature
+HTML_SCAN_SIZE = 65536
+# GFI answers without any feature, by info_format
+EMPTY_GFI = {
+    "application/vnd.ogc.gml": '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<msGMLOutput xmlns:gml="http://www.opengis.net/gml"'
+    ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n'
+    "</msGMLOutput>\n",
+    "text/html": "<html><body></body></html>\n",
+}
+# getmap params left out of the tiles cache key, always the same there
+TILE_KEY_IGNORED = frozenset(("service", "request"))
+# getmap params with case insensitive values
+TILE_KEY_LOWER = frozenset(("format", "crs", "srs"))
+# the tiles cache is shared by the request threads
+TILES_LOCK = threading.Lock()
+# images are drawn and merged in RGBA, starting from a transparent canvas
+MODE = "RGBA"
+TRANSPARENT = (0, 0, 0, 0)
+# font of the error messages, loaded once
+try:
+    ERR_FONT = ImageFont.truetype("DejaVuSansMono.ttf", 10)
+except OSError:
+    ERR_FONT = ImageFont.load_default()
 
 
 def empty_image(height, width, fmt, message=None):
-    canvas = Image.new("RGBA", (width, height), (0, 0, 0, 0))
-    if message and height > 300 and width > 300:
-        font = ImageFont.truetype("DejaVuSansMono.ttf", 10)
-        img_draw = ImageDraw.Draw(canvas)
-        box = img_draw.multiline_textsize(message, font=font)
-        # calculate position
-        x = (width - box[0]) // 2
-        y = (height - box[1]) // 2
-        img_draw.multiline_text((x, y), message, fill="red", font=font)
+    if not message or height <= 300 or width <= 300:
+        return image_response(empty_image_bytes(height, width, fmt), fmt)
+    canvas = Image.new(MODE, (width, height), TRANSPARENT)
+    img_draw = ImageDraw.Draw(canvas)
+    box = img_draw.multiline_textsize(message, font=ERR_FONT)
+    # calculate position
+    x = (width - box[0]) // 2
+    y = (height - box[1]) // 2
+    img_draw.multiline_text((x, y), message, fill="red", font=ERR_FONT)
     img_io = BytesIO()
     canvas.save(img_io, fmt.split("/")[1].upper())
-    img_io.seek(0)
-    return send_file(img_io, mimetype=fmt)
+    return image_response(img_io.getvalue(), fmt)
+
+
+# encoded empty transparent image, clients only use a few tile sizes
+@lru_cache(maxsize=128)
+def empty_image_bytes(height, width, fmt):
+    canvas = Image.new(MODE, (width, height), TRANSPARENT)
+    img_io = BytesIO()
+    canvas.save(img_io, fmt.split("/")[1].upper())
+    return img_io.getvalue()
+
+
+# return an in-memory image, cacheable by clients unless told otherwise
+def image_response(data, fmt, etag=None, cacheable=True):
+    resp = Response(data, mimetype=fmt)
+    resp.headers["Content-Length"] = str(len(data))
+    if not cacheable:
+        resp.cache_control.no_store = True
+        return resp
+    resp.cache_control.public = True
+    resp.cache_control.max_age = app.config.cache_max_age
+    if etag:
+        # answers 304 if the client already has this image
+        resp.set_etag(etag)
+        resp.make_conditional(request)
+    return resp
+
+
+# tiles cache key for getmap params, so that equivalent queries share a tile
+def tile_key(args):
+    return tuple(
+        sorted(
+            (k, v.lower() if k in TILE_KEY_LOWER else v)
+            for k, v in args.items()
+            if k not in TILE_KEY_IGNORED
+        )
+    )
+
+
+# return the (data, mimetype, etag) of a merged tile, or None
+def get_cached_tile(key):
+    with TILES_LOCK:
+        return app.config.tiles_cache.get(key)
+
+
+# store a merged tile, return its etag
+def cache_tile(key, data, fmt):
+    etag = hashlib.blake2b(data, digest_size=16).hexdigest()
+    with TILES_LOCK:
+        try:
+            app.config.tiles_cache[key] = (data, fmt, etag)
+        except ValueError:
+            # larger than the whole cache
+            pass
+    return etag
+
+
+# merge upstream tiles (in comms order) into a single RGBA image
+def merge_tiles(tiles, width, height):
+    # start with an empty transparent image, in case all queries fail..
+    out = Image.new(MODE, (width, height), TRANSPARENT)
+    for resp in tiles:
+        # blend in place, dont allocate a new image per comm
+        out.alpha_composite(Image.open(BytesIO(resp.content)).convert(MODE))
+    return out
+
+
+# tell if a GML response has at least one feature
+def gml_has_feature(content):
+    if etree is not None:
+        return GML_MEMBER_XP(etree.fromstring(content, GML_PARSER))
+    # without lxml, stop parsing at the first feature
+    depth = 0
+    for event, elem in ET.iterparse(BytesIO(content), events=("start", "end")):
+        if event == "end":
+            depth -= 1
+            continue
+        # only look at the children of the root element
+        if depth == 1 and elem.tag in GML_MEMBER_TAGS:
+            return True
+        depth += 1
+    return False
+
+
+# fetch a single upstream url, return the response or None on error
+def fetch(url):
+    try:
+        resp = app.config.http.get(url, timeout=UPSTREAM_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        app.logger.error(e)
+        return None
+    if resp.status_code != 200 and resp.status_code != 503:
+        app.logger.error(
+            "{} => {} (mimetype {})".format(
+                url, resp.status_code, resp.headers.get("content-type")
+            )
+        )
+        return None
+    return resp
 
 
 def report_exception(message):
@@ -88,240 +338,338 @@ def report_exception(message):
     return message, 405
 
 
+# crs for which the reprojected bbox corners give a good enough l93 bbox
+RECT_EPSG = (2154, 4326, 3857)
+
+
+# return the bbox of the 4 reprojected corners of a bbox
+def transform_rect(t, xmin, ymin, xmax, ymax):
+    corners = [
+        t.TransformPoint(x, y)
+        for x, y in ((xmin, ymin), (xmin, ymax), (xmax, ymax), (xmax, ymin))
+    ]
+    xs = [c[0] for c in corners]
+    ys = [c[1] for c in corners]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
 # return a list of insee codes for a given bbox
 def get_insee_for_bbox(xmin, ymin, xmax, ymax, epsg):
+    # tiled clients query the same bboxes over and over
+    p = app.config.insee_cache_precision
+    return cached_insee_for_bbox(
+        round(xmin, p), round(ymin, p), round(xmax, p), round(ymax, p), epsg
+    )
+
+
+# return a tuple of insee codes for a given bbox, cached
+@lru_cache(maxsize=4096)
+def cached_insee_for_bbox(xmin, ymin, xmax, ymax, epsg):
     layer = get_layer()
     comms = list()
-    if epsg != "2154":
+    lxmin, lxmax, lymin, lymax = app.config.l93bbox
+    if epsg in RECT_EPSG:
+        if epsg != 2154:
+            xmin, ymin, xmax, ymax = transform_rect(
+                get_transform(epsg), xmin, ymin, xmax, ymax
+            )
+        # bbox outside of the layer, nothing to query
+        if xmin > lxmax or xmax < lxmin or ymin > lymax or ymax < lymin:
+            return ()
+        # no need to filter if the bbox covers the whole layer
+        if not (xmin <= lxmin and ymin <= lymin and xmax >= lxmax and ymax >= lymax):
+            layer.SetSpatialFilterRect(xmin, ymin, xmax, ymax)
+    else:
         ring = ogr.Geometry(ogr.wkbLinearRing)
-        ring.AddPoint(float(xmax), float(ymin))
-        ring.AddPoint(float(xmax), float(ymax))
-        ring.AddPoint(float(xmin), float(ymax))
-        ring.AddPoint(float(xmin), float(ymin))
-        ring.AddPoint(float(xmax), float(ymin))
+        ring.AddPoint(xmax, ymin)
+        ring.AddPoint(xmax, ymax)
+        ring.AddPoint(xmin, ymax)
+        ring.AddPoint(xmin, ymin)
+        ring.AddPoint(xmax, ymin)
         poly = ogr.Geometry(ogr.wkbPolygon)
         poly.AddGeometry(ring)
-        s_srs = osr.SpatialReference()
-        s_srs.ImportFromEPSG(epsg)
-        t_srs = osr.SpatialReference()
-        t_srs.ImportFromEPSG(2154)
-        poly.Transform(osr.CoordinateTransformation(s_srs, t_srs))
+        poly.Transform(get_transform(epsg))
+        pxmin, pxmax, pymin, pymax = poly.GetEnvelope()
+        if pxmin > lxmax or pxmax < lxmin or pymin > lymax or pymax < lymin:
+            return ()
         layer.SetSpatialFilter(poly)
-    else:
-        layer.SetSpatialFilterRect(xmin, ymin, xmax, ymax)
     for feature in layer:
         comms.append(feature.GetField(app.config.champ_insee))
     layer.ResetReading()
     layer.SetSpatialFilter(None)
-    return comms
+    # a comm can be split in several features, keep each one once
+    return tuple(dict.fromkeys(comms))
+
+
+app = Flask(__name__, template_folder=".")
+init_app(app)
+
+
+# url of the WMS service of a comm
+def upstream_url(comm, qstr):
+    return "https://inspire.cadastre.gouv.fr/scpc/{}/{}.wms?{}".format(
+        app.config.apikey,
+        comm,
+        qstr,
+    )
+
+
+# validate the params shared by getmap and getfeatureinfo, return
+# ((epsg, fmt, height, width, bbox), None) or (None, response to send back)
+# nothing here touches gdal/ogr, the size/scale checks run before any of it
+def parse_map_args(args, query):
+    if not all(key in args for key in ("bbox", "width", "height", "layers")):
+        return None, report_exception(
+            "bbox, crs, width, height, layers & format parameters are mandatory for getmap"
+        )
+
+    # validate crs
+    crs = args.get("crs")
+    if not crs:
+        crs = args.get("srs")
+    if not crs:
+        return None, report_exception(
+            "bbox, srs/crs, width, height, layers & format parameters are mandatory for getmap"
+        )
+    epsg = 2154
+    if ":" in crs:
+        x = crs.split(":")[1]
+        if x.isnumeric():
+            epsg = int(x)
+    # validate format
+    fmt = args.get("format", "").lower()
+    if fmt not in ("image/png") and query == "getmap":
+        return None, report_exception(
+            "Format d'image non pris en compte: {}".format(fmt)
+        )
+
+    # validate height/width
+    height = args.get("height", "")
+    width = args.get("width", "")
+    if not height.isnumeric() or not width.isnumeric():
+        return None, report_exception("height and width should be numeric values")
+    height = int(height)
+    width = int(width)
+    if query == "getmap" and width > 1280:
+        return None, empty_image(
+            height,
+            width,
+            fmt,
+            "le service de la DGFiP ne supporte pas les images de plus de 1280px de large",
+        )
+
+    # validate that bbox only has 4 values
+    try:
+        xmin, ymin, xmax, ymax = map(float, args.get("bbox").split(","))
+    except ValueError:
+        return None, report_exception(
+            "bbox should look like xmin,ymin,xmax,ymax with only numeric values"
+        )
+    # validate scale
+    scale = (xmax - xmin) / (width * 0.00028)
+    if (
+        (scale > 10000 and args.get("layers") == "CP.CadastralParcel")
+        or (scale > 10000 and args.get("layers") == "BU.Building")
+        or scale > 26000
+    ):
+        # return empty transparent image
+        return None, empty_image(height, width, fmt)
+
+    return (epsg, fmt, height, width, (xmin, ymin, xmax, ymax)), None
+
+
+def handle_getcapabilities(args):
+    get_layer()
+    return Response(
+        render_template(
+            "getcap.xml.j2",
+            proto=request.headers.get("X-Forwarded-Proto", "http"),
+            host=request.headers.get("X-Forwarded-Host", "localhost"),
+            l93bbox=app.config.l93bbox,
+            llbbox=app.config.llbbox,
+            reqpath=request.path,
+        ),
+        mimetype="text/xml",
+    )
+
+
+def handle_getmap(args):
+    parsed, resp = parse_map_args(args, "getmap")
+    if resp is not None:
+        return resp
+    epsg, fmt, height, width, bbox = parsed
+
+    # same getmap params, same image
+    key = tile_key(args)
+    cached = get_cached_tile(key)
+    if cached:
+        return image_response(*cached)
+
+    qstr = request.query_string.decode("unicode_escape")
+    comms = get_insee_for_bbox(*bbox, epsg)
+    # matche a single comm, return a 302 with the right url
+    if len(comms) == 1:
+        app.logger.debug(
+            "getmap {} (EPSG:{}) => 302 w/ {}".format(args.get("bbox"), epsg, comms[0])
+        )
+        return redirect(upstream_url(comms[0], qstr), code=302)
+
+    # do X queries
+    app.logger.debug(
+        "getmap {} (EPSG:{}) => merging for {}".format(args.get("bbox"), epsg, comms)
+    )
+    urls = [upstream_url(comm, "transparent=true&" + qstr) for comm in comms]
+    # query all comms concurrently, keep comms order when merging images
+    ex = ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(urls))))
+    try:
+        resps = list(ex.map(fetch, urls))
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
+    # only keep the responses that are images
+    tiles = [
+        resp
+        for resp in resps
+        if resp is not None
+        and resp.headers.get("content-type", "").startswith("image/")
+    ]
+    # a single usable tile, send it as is without decoding it
+    if len(tiles) == 1:
+        data = tiles[0].content
+        mimetype = tiles[0].headers.get("content-type")
+    else:
+        out = merge_tiles(tiles, width, height)
+        img_io = BytesIO()
+        outmode = fmt.split("/")[1].upper()
+        # fast zlib level, the merged image is sent right away
+        out.save(img_io, outmode, optimize=False, compress_level=1)
+        data = img_io.getvalue()
+        mimetype = fmt
+    # some comms failed, dont let anyone keep an incomplete image
+    if len(tiles) != len(comms):
+        return image_response(data, mimetype, cacheable=False)
+    return image_response(data, mimetype, cache_tile(key, data, mimetype))
+
+
+def handle_getfeatureinfo(args):
+    parsed, resp = parse_map_args(args, "getfeatureinfo")
+    if resp is not None:
+        return resp
+    epsg, fmt, height, width, bbox = parsed
+
+    # upstream gets uppercase parameters names
+    params = {k.upper(): v for k, v in args.items()}
+    # rewrite WMS 1.1.1 GFI requests done by mapstore to WMS 1.3.0
+    if params.get("VERSION") != "1.3.0":
+        params["VERSION"] = "1.3.0"
+        for old, new in (("SRS", "CRS"), ("X", "I"), ("Y", "J")):
+            if old in params:
+                params[new] = params.pop(old)
+        # mandatory args
+        params["FORMAT"] = "image/png"
+        params["STYLES"] = ""
+
+    # rescale height/width for gfi on large images ? edge case...
+    if width > 1280:
+        nh = int(height * 1280 / width)
+        params["WIDTH"] = "1280"
+        params["HEIGHT"] = str(nh)
+        params["I"] = str(int(int(params.get("I", 0)) * 1280 / width))
+        params["J"] = str(int(int(params.get("J", 0)) * nh / height))
+
+    # handle GFI on multiple layers/non-queryable layers -> query
+    # CP.CadastralParcel by default unless BU.Building is listed
+    ql = params.get("QUERY_LAYERS", "")
+    if ql not in ("CP.CadastralParcel", "BU.Building"):
+        if "CP.CadastralParcel" in ql or "BU.Building" not in ql:
+            params["QUERY_LAYERS"] = params["LAYERS"] = "CP.CadastralParcel"
+        else:
+            params["QUERY_LAYERS"] = params["LAYERS"] = "BU.Building"
+    qstr = urlencode(params, safe=",:/")
+
+    comms = get_insee_for_bbox(*bbox, epsg)
+    # matche a single comm, return a 302 with the right url
+    if len(comms) == 1:
+        app.logger.debug(
+            "getfeatureinfo {} (EPSG:{}) => 302 w/ {}".format(
+                args.get("bbox"), epsg, comms[0]
+            )
+        )
+        return redirect(upstream_url(comms[0], qstr), code=302)
+    # no comm there, nothing to query
+    if not comms:
+        info_format = args.get("info_format")
+        if info_format != "application/vnd.ogc.gml":
+            info_format = "text/html"
+        return Response(EMPTY_GFI[info_format], mimetype=info_format)
+
+    # do X queries
+    app.logger.debug(
+        "getfeatureinfo {} (EPSG:{}) => merging for {}".format(
+            args.get("bbox"), epsg, comms
+        )
+    )
+    urls = [upstream_url(comm, "transparent=true&" + qstr) for comm in comms]
+    # query all comms concurrently
+    ex = ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(urls))))
+    try:
+        resp = None
+        futures = [ex.submit(fetch, url) for url in urls]
+        for future in as_completed(futures):
+            r = future.result()
+            if r is None:
+                continue
+            resp = r
+            if args.get("info_format") == "application/vnd.ogc.gml":
+                # XX returns the first comm that gives a feature
+                if gml_has_feature(resp.content):
+                    return Response(
+                        resp.content, mimetype=resp.headers.get("content-type")
+                    )
+            # text/html
+            else:
+                # XX returns the first comm that gives a feature in the HTML (eg non-empty table)
+                if resp.content.find(b"inspireId", 0, HTML_SCAN_SIZE) != -1:
+                    return Response(
+                        resp.content, mimetype=resp.headers.get("content-type")
+                    )
+    finally:
+        # dont wait for pending queries once we have an answer
+        ex.shutdown(wait=False, cancel_futures=True)
+    # if we're here, none of the GFI returned a feature - return the last resp ?
+    if resp is None:
+        return report_exception("no valid response from upstream")
+    return Response(resp.content, mimetype=resp.headers.get("content-type"))
+
+
+HANDLERS = {
+    "getcapabilities": handle_getcapabilities,
+    "getmap": handle_getmap,
+    "getfeatureinfo": handle_getfeatureinfo,
+}
 
 
 @app.route("/", methods=["GET"], defaults={"u_path": ""})
 @app.route("/<path:u_path>", methods=["GET"])
 def main(u_path):
 
-    args = CaseInsensitiveDict(request.args)
+    # WMS parameters names are case insensitive
+    args = {k.lower(): v for k, v in request.args.items()}
     service = args.get("service", "").lower()
     if not service:
         return report_exception("service parameter is mandatory")
-    if service != "wms":
+    if service not in SERVICES:
         return report_exception("unknown service type, only wms is supported")
 
     query = args.get("request", "").lower()
     if not query:
         return report_exception("request parameter is mandatory")
-    if query != "getcapabilities" and query != "getmap" and query != "getfeatureinfo":
+    if query not in HANDLERS:
         return report_exception(
             "unknown request type {}, only getcapabilities, getmap and getfeatureinfo are supported".format(
                 query
             ),
         )
-
-    if query == "getcapabilities":
-        get_layer()
-        return Response(
-            render_template(
-                "getcap.xml.j2",
-                proto=request.headers.get("X-Forwarded-Proto", "http"),
-                host=request.headers.get("X-Forwarded-Host", "localhost"),
-                l93bbox=app.config.l93bbox,
-                llbbox=app.config.llbbox,
-                reqpath=request.path,
-            ),
-            mimetype="text/xml",
-        )
-
-    # now service is getmap, check all mandatory params
-    if all(key in args for key in ("bbox", "width", "height", "layers")):
-
-        # validate crs
-        crs = args.get("crs")
-        if not crs:
-            crs = args.get("srs")
-        if not crs:
-            return report_exception(
-                "bbox, srs/crs, width, height, layers & format parameters are mandatory for getmap"
-            )
-        epsg = 2154
-        if ":" in crs:
-            x = crs.split(":")[1]
-            if x.isnumeric():
-                epsg = int(x)
-        # validate format
-        fmt = args.get("format", "").lower()
-        if fmt not in ("image/png") and query == "getmap":
-            return report_exception("Format d'image non pris en compte: {}".format(fmt))
-
-        # validate height/width
-        height = args.get("height", "")
-        width = args.get("width", "")
-        if not height.isnumeric() or not width.isnumeric():
-            return report_exception("height and width should be numeric values")
-        height = int(height)
-        width = int(width)
-        if query == "getmap" and width > 1280:
-            return empty_image(
-                height,
-                width,
-                fmt,
-                "le service de la DGFiP ne supporte pas les images de plus de 1280px de large",
-            )
-
-        # validate that bbox only has 4 values
-        bbox = args.get("bbox")
-        if bbox.count(",") != 3:
-            return report_exception(
-                "bbox should look like xmin,ymin,xmax,ymax with only numeric values"
-            )
-        [sxmin, symin, sxmax, symax] = map(lambda s: s.split(".")[0], bbox.split(","))
-        #        if not isint(sxmin) or not isint(symin) or not isint(sxmax) or not isint(symax):
-        #            return report_exception("bbox should look like xmin,ymin,xmax,ymax with only numeric values")
-        # validate scale
-        scale = (float(sxmax) - float(sxmin)) / (width * 0.00028)
-        if (
-            (scale > 10000 and args.get("layers") == "CP.CadastralParcel")
-            or (scale > 10000 and args.get("layers") == "BU.Building")
-            or scale > 26000
-        ):
-            # return empty transparent image
-            return empty_image(height, width, fmt)
-
-        # rewrite WMS 1.1.1 GFI requests done by mapstore to WMS 1.3.0
-        qstr = request.query_string.decode("unicode_escape")
-        if query == "getfeatureinfo" and args.get("version") != "1.3.0":
-            qstr = qstr.replace("version=1.1.1", "version=1.3.0")
-            qstr = qstr.replace("&srs=", "&crs=")
-            qstr = qstr.replace("&x=", "&i=")
-            qstr = qstr.replace("&y=", "&j=")
-            # append mandatory args
-            qstr = qstr + "&format=image/png&styles="
-
-        # rescale height/width for gfi on large images ? edge case...
-        if query == "getfeatureinfo" and width > 1280:
-            qstr = qstr.replace("WIDTH={}".format(width), "WIDTH=1280")
-            nh = int(height * 1280 / width)
-            qstr = qstr.replace("HEIGHT={}".format(height), "HEIGHT={}".format(nh))
-            ii = int(args.get("I", 0))
-            nii = int(ii * 1280 / width)
-            ij = int(args.get("J", 0))
-            nij = int(ij * nh / height)
-            qstr = qstr.replace("I={}".format(ii), "I={}".format(nii))
-            qstr = qstr.replace("J={}".format(ij), "J={}".format(nij))
-
-        # handle GFI on multiple layers/non-queryable layers -> query
-        # CP.CadastralParcel by default unless BU.Building is listed
-        if query == "getfeatureinfo" and args.get("query_layers") not in (
-            "CP.CadastralParcel",
-            "BU.Building",
-        ):
-            qlpat = re.compile("&query_layers=[^&]*", re.IGNORECASE)
-            lpat = re.compile("&layers=[^&]*", re.IGNORECASE)
-            ql = args.get("query_layers")
-            if "CP.CadastralParcel" in ql or "BU.Building" not in ql:
-                qstr = lpat.sub(
-                    "&LAYERS=CP.CadastralParcel",
-                    qlpat.sub("&QUERY_LAYERS=CP.CadastralParcel", qstr),
-                )
-            else:
-                qstr = lpat.sub(
-                    "&LAYERS=BU.Building", qlpat.sub("&QUERY_LAYERS=BU.Building", qstr)
-                )
-
-        comms = get_insee_for_bbox(sxmin, symin, sxmax, symax, epsg)
-        # matche a single comm, return a 302 with the right url
-        if len(comms) == 1:
-            app.logger.debug(
-                "{} {} (EPSG:{}) => 302 w/ {}".format(query, bbox, epsg, comms[0])
-            )
-            url = "https://inspire.cadastre.gouv.fr/scpc/{}/{}.wms?{}".format(
-                app.config.apikey,
-                comms[0],
-                qstr,
-            )
-            return redirect(url, code=302)
-        # do X queries
-        else:
-            app.logger.debug(
-                "{} {} (EPSG:{}) => merging for {}".format(query, bbox, epsg, comms)
-            )
-            nb = 0
-            # start with an empty transparent image, in case all queries fail..
-            out = Image.new("RGBA", (width, height), (0, 0, 0, 0))
-            for comm in comms:
-                url = "https://inspire.cadastre.gouv.fr/scpc/{}/{}.wms?transparent=true&{}".format(
-                    app.config.apikey,
-                    comm,
-                    qstr,
-                )
-                try:
-                    resp = get(url, args)
-                except requests.exceptions.RequestException as e:
-                    app.logger.error(e)
-                    continue
-                if resp.status_code != 200 and resp.status_code != 503:
-                    app.logger.error(
-                        "{} => {} (mimetype {})".format(
-                            url, resp.status_code, resp.headers.get("content-type")
-                        )
-                    )
-                    continue
-                if query == "getfeatureinfo":
-                    if args.get("info_format") == "application/vnd.ogc.gml":
-                        root = ET.fromstring(resp.content)
-                        for child in root:
-                            # XX returns the first comm that gives a feature
-                            if child.tag.endswith("member"):
-                                return Response(
-                                    resp.content,
-                                    mimetype=resp.headers.get("content-type"),
-                                )
-                    # text/html
-                    else:
-                        # XX returns the first comm that gives a feature in the HTML (eg non-empty table)
-                        if b"inspireId" in resp.content:
-                            return Response(
-                                resp.content, mimetype=resp.headers.get("content-type")
-                            )
-                else:
-                    im = Image.open(BytesIO(resp.content))
-                    if nb == 0:
-                        out = im
-                    else:
-                        out = Image.alpha_composite(out, im)
-                    nb += 1
-            # if we're here, none of the GFI returned a feature - return the last resp ?
-            if query == "getfeatureinfo":
-                return Response(resp.content, mimetype=resp.headers.get("content-type"))
-            img_io = BytesIO()
-            outmode = fmt.split("/")[1].upper()
-            out.save(img_io, outmode)
-            img_io.seek(0)
-            return send_file(img_io, mimetype=fmt)
-
-    else:
-        return report_exception(
-            "bbox, crs, width, height, layers & format parameters are mandatory for getmap"
-        )
+    return HANDLERS[query](args)
 
 
 if __name__ == "__main__":